@@ -4,56 +4,377 @@ import os
 # This script:
 # - connects to a Windows ArcGIS server via SSH
 # - Connects to the ARCGis server using arcpy and an SDE connection file
-# - Downloads a layer from the server
+# - Downloads a layer from the server (or a batch of layers, see BATCH_LAYERS below)
 # - Selects rows based on an SQL query
 # - Renames columns based on configuration
 # - Converts the layer to:
 #   - CSV
-#   - KML
+#   - KML (KML_DESCRIPTION_FIELDS limits the fields shown in the placemarks' description)
 #   - GeoJSON
 #   - GeoXML
+#   - Optionally, simplified (lighter) GeoJSON and KML variants - set SIMPLIFY_TOLERANCES to a comma separated
+#     list of positive tolerances in meters, e.g. '2,10'. Polygon layers are simplified as a whole, so that
+#     neighbouring polygons keep their shared edges.
+#   The layer is parsed and validated once, and the format writers then run in parallel, in a pool of
+#   WRITER_PROCESSES processes (defaults to the number of CPUs)
 # - Uploads the original SHP and all converted files to CKAN
 # - Uploads the GeoJSON to an Azure Blobstore
+#   (optionally with a PMTiles vector tile archive of the layer - set VECTOR_TILES=true,
+#    and VECTOR_TILES_MIN_ZOOM / VECTOR_TILES_MAX_ZOOM to control the zoom range)
+#   together with gzip and brotli compressed variants of the GeoJSON, whose URLs are stored in the url_gzip / url_br
+#   fields of the GeoJSON resource in CKAN, so that clients can fetch the compressed GeoJSON directly
+#
+# Batch mode: set BATCH_LAYERS to a JSON list of per-layer configurations, e.g.
+#   [{"LAYER_NAME": "roads", "SDE_PATH": "...", "DATASET_NAME": "roads", ...}, ...]
+# Each item overrides the matching env vars. All layers are exported in a single remote invocation,
+# packed into a single archive on the Windows side and fetched over a single SSH connection.
+# LAYER_NAMEs must be unique within a batch. A layer which fails to export or convert doesn't stop the others,
+# the failed layers are listed at the end and the script exits with an error.
 
-def parse_shapefile(layername, convert):
+# Number of decimal digits kept in the coordinates of simplified geometries - ~10cm in both projections
+COORDINATE_PRECISION = {True: 6, False: 1}
+# Number of features validated and reprojected together
+PARSE_CHUNK_SIZE = 10000
+
+
+# Field types whose values are exported as ISO strings
+DATE_FIELD_TYPES = ('D',)
+
+
+class ShapefileLayer(object):
+    # Lazy access to the .shp/.dbf/.shx files of a layer.
+    # The files are memory mapped, so that writers running in parallel share their pages instead of each reading a copy.
+    # Records are located by their offset in the .shx index, and only the requested fields are decoded.
+
+    def __init__(self, layername):
+        import mmap
+        import numpy
+        import shapefile
+
+        self.files = dict()
+        for ext in ('shp', 'dbf', 'shx'):
+            with open('%s.%s' % (layername, ext), 'rb') as f:
+                self.files[ext] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.reader = shapefile.Reader(**self.files)
+        self.field_types = dict((field[0], field[1]) for field in self.reader.fields[1:])
+        self.fields = [field[0] for field in self.reader.fields[1:]]
+        # Decoded as dates - chosen once by the fields' type, instead of checking each value
+        self.date_fields = set(field[0] for field in self.reader.fields[1:] if field[1] in DATE_FIELD_TYPES)
+        # Each index entry holds the record's offset and length in 16 bit words, big endian
+        index = numpy.frombuffer(self.files['shx'], dtype='>i4', offset=100).reshape(-1, 2)
+        self.offsets = index[:, 0].astype(numpy.int64) * 2
+        self.shp = numpy.frombuffer(self.files['shp'], dtype=numpy.uint8)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _read(self, start, stop, position, dtype):
+        # Reads a value at the same position in the content of each of the records - without decoding the shapes
+        import numpy
+        dtype = numpy.dtype(dtype)
+        positions = self.offsets[start:stop, None] + 8 + position + numpy.arange(dtype.itemsize)
+        return self.shp[positions].view(dtype).ravel()
+
+    def shape_types(self, start, stop):
+        return self._read(start, stop, 0, '<i4')
+
+    def points(self, start, stop, is_point):
+        # Coordinates of the point records (NaN for the others, whose content may be shorter than a point's)
+        import numpy
+        offsets = self.offsets[start:stop][is_point, None] + 8 + numpy.arange(16)
+        lons, lats = numpy.full(stop - start, numpy.nan), numpy.full(stop - start, numpy.nan)
+        if len(offsets):
+            coords = self.shp[offsets + 4].view('<f8')
+            lons[is_point], lats[is_point] = coords[:, 0], coords[:, 1]
+        return lons, lats
+
+    def shapes(self, indexes):
+        return [self.reader.shape(int(i)) for i in indexes]
+
+    def records(self, indexes, fields=None):
+        # Only the given fields are decoded (all of them by default)
+        import datetime
+        fields = self.fields if fields is None else [f for f in self.fields if f in fields]
+        ret = []
+        for i in indexes:
+            rec = self.reader.record(int(i), fields=fields) if fields else None
+            # The values are in the order of the fields in the file
+            rec = dict(zip(fields, rec)) if rec is not None else {}
+            for f in self.date_fields.intersection(rec):
+                # Invalid dates are read as strings
+                if isinstance(rec[f], datetime.date):
+                    rec[f] = rec[f].isoformat()
+            ret.append(rec)
+        return ret
+
+    def close(self):
+        self.reader.close()
+
+
+# The shapefile is parsed and validated only once, into an intermediate directory (<layer>.parsed) which the writers
+# memory map - so writers running in parallel share a single copy of the parsed layer instead of each parsing it again.
+# It holds:
+# - rows.npy: the row numbers of the valid features in the shapefile, whose records are read from the (memory mapped)
+#   .dbf file when written - decoding only the fields each writer needs
+# - <variant>.wkb / <variant>.offsets.npy: the features' geometries, as concatenated WKB and their offsets
+# - <variant>.points.npy: the coordinates of point features (NaN for other features), for the lat/lon fields
+# The 'itm' variant holds the validated geometries. The other variants ('wgs84', and 'itm.<tolerance>m' /
+# 'wgs84.<tolerance>m' for simplified ones) are derived from it, and share its rows.
+
+def parsed_path(layername):
+    return '%s.parsed' % layername
+
+
+def parsed_variant(convert, tolerance=None):
+    variant = 'wgs84' if convert else 'itm'
+    if tolerance:
+        variant += '.%gm' % tolerance
+    return variant
+
+
+class ParsedLayerWriter(object):
+    # Appends chunks of geometries (and row numbers, for the 'itm' variant) to a variant of the parsed layer.
+    # The points file is written last, and marks the variant as complete.
+
+    def __init__(self, path, variant, rows=False):
+        self.path = path
+        self.variant = variant
+        self.geometries = open(os.path.join(path, '%s.wkb' % variant), 'wb')
+        self.geometry_offsets = [0]
+        self.points = []
+        self.rows = [] if rows else None
+
+    def append(self, geoms, rows=None):
+        import numpy
+        import shapely
+
+        for wkb in shapely.to_wkb(geoms):
+            self.geometries.write(wkb)
+            self.geometry_offsets.append(self.geometry_offsets[-1] + len(wkb))
+        points = numpy.full((len(geoms), 2), numpy.nan)
+        is_point = shapely.get_type_id(geoms) == shapely.GeometryType.POINT
+        points[is_point, 0] = shapely.get_x(geoms[is_point])
+        points[is_point, 1] = shapely.get_y(geoms[is_point])
+        self.points.append(points)
+        if self.rows is not None:
+            self.rows.append(rows)
+
+    def close(self):
+        import numpy
+
+        self.geometries.close()
+        numpy.save(os.path.join(self.path, '%s.offsets.npy' % self.variant), numpy.array(self.geometry_offsets, dtype=numpy.int64))
+        if self.rows is not None:
+            rows = numpy.concatenate(self.rows) if self.rows else numpy.empty(0)
+            numpy.save(os.path.join(self.path, 'rows.npy'), rows.astype(numpy.int64))
+        points = numpy.concatenate(self.points) if self.points else numpy.empty((0, 2))
+        numpy.save(os.path.join(self.path, '%s.points.npy' % self.variant), points)
+
+
+class ParsedLayer(object):
+    # Read only access to a variant of the parsed layer, through memory maps
+
+    def __init__(self, layername, variant):
+        import numpy
+
+        self.path = parsed_path(layername)
+        self.shapefile = ShapefileLayer(layername)
+        self.fields = self.shapefile.fields
+        self.field_types = self.shapefile.field_types
+        self.rows = numpy.load(os.path.join(self.path, 'rows.npy'), mmap_mode='r')
+        self.geometries_data = self._map('%s.wkb' % variant)
+        self.geometry_offsets = numpy.load(os.path.join(self.path, '%s.offsets.npy' % variant), mmap_mode='r')
+        self.points = numpy.load(os.path.join(self.path, '%s.points.npy' % variant), mmap_mode='r')
+
+    def _map(self, filename):
+        import mmap
+        with open(os.path.join(self.path, filename), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.points)
+
+    def geometries(self, start, stop):
+        import shapely
+        offsets = self.geometry_offsets[start:stop + 1]
+        return shapely.from_wkb([self.geometries_data[a:b] for a, b in zip(offsets[:-1], offsets[1:])])
+
+    def records(self, indexes, fields=None):
+        # Records of the features at the given indexes, with only the given fields decoded (all of them by default)
+        import numpy
+        return self.shapefile.records(self.rows[numpy.asarray(indexes, dtype=numpy.int64)], fields)
+
+    def close(self):
+        self.shapefile.close()
+        if self.geometries_data:
+            self.geometries_data.close()
+
+
+def build_parsed_layer(layername):
+    # Parses the shapefile into the 'itm' variant of the parsed layer - rejecting unparseable geometries and repairing
+    # invalid ones - and writes the validation report.
+    # No fields are decoded here, the records are read by the writers.
+    import json
+    import shutil
+    import numpy
     import shapefile
+    import shapely
+
+    path = parsed_path(layername)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    layer = ShapefileLayer(layername)
+    out = ParsedLayerWriter(path, parsed_variant(False), rows=True)
+    issues = []
+    for start in range(0, len(layer), PARSE_CHUNK_SIZE):
+        stop = min(start + PARSE_CHUNK_SIZE, len(layer))
+
+        # Points are read directly from the .shp file, without decoding their shapes
+        shape_types = layer.shape_types(start, stop)
+        is_point = numpy.isin(shape_types, (shapefile.POINT, shapefile.POINTM, shapefile.POINTZ))
+        lons, lats = layer.points(start, stop, is_point)
+        is_point &= numpy.isfinite(lons) & numpy.isfinite(lats)
+        geoms = numpy.full(stop - start, None, dtype=object)
+        geoms[is_point] = shapely.points(lons[is_point], lats[is_point])
+
+        # Other shapes are parsed through their GeoJSON representation
+        geojsons = numpy.full(stop - start, None, dtype=object)
+        to_parse = numpy.flatnonzero(~is_point & (shape_types != shapefile.NULL))
+        for i, shape in zip(to_parse, layer.shapes(start + to_parse)):
+            try:
+                geojsons[i] = json.dumps(shape.__geo_interface__)
+            except Exception:
+                # e.g. MULTIPATCH shapes, which have no GeoJSON representation - rejected below
+                continue
+        geoms[~is_point] = shapely.from_geojson(geojsons[~is_point], on_invalid='ignore')
+
+        # Validate and repair the whole chunk at once - unparseable geometries are rejected, invalid ones are fixed
+        rejected = shapely.is_missing(geoms)
+        invalid = ~rejected & ~shapely.is_valid(geoms)
+        issues.extend(
+            (start + i, 'REJECTED', 'unparseable geometry' if shape_types[i] != shapefile.NULL else 'null geometry')
+            for i in numpy.flatnonzero(rejected)
+        )
+        issues.extend(
+            (start + i, 'REPAIRED', reason)
+            for i, reason in zip(numpy.flatnonzero(invalid), shapely.is_valid_reason(geoms[invalid]))
+        )
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+
+        valid = numpy.flatnonzero(~rejected)
+        out.append(geoms[valid], start + valid)
+    out.close()
+
+    write_validation_report(layername, layer, issues)
+    layer.close()
+
+
+def derive_parsed_layer(layername, convert, tolerance=None):
+    # Creates a variant of the parsed layer from the validated geometries.
+    # When tolerance (in ITM meters) is given, geometries are simplified and their coordinates quantized.
+    import numpy
+    import shapely
     if convert:
         from pyproj import Transformer
-        from shapely.ops import transform
-        from shapely.geometry import shape, mapping
         transformer = Transformer.from_crs('EPSG:2039', 'EPSG:4326', always_xy=True)
-   
-    reader = shapefile.Reader(layername)
-    fields = reader.fields[1:]
-    field_names = [field[0] for field in fields] + ['lat', 'lon']
-    buffer = []
-    for sr in reader.shapeRecords():
-        try:
-            geom = sr.shape.__geo_interface__
-            rec = sr.record.as_dict()
-            rec = dict((k,v) for k,v in rec.items() if isinstance(v, (int, float, str, bool, type(None))))
-            if convert:
-                geom = transform(transformer.transform, shape(geom))
-                geom = mapping(geom)
-            try:
-                if geom['type'] == 'Point':
-                    rec['lon'], rec['lat'] = geom['coordinates']
-                else:
-                    rec['lon'], rec['lat'] = None, None
-            except:
-                logging.exception('Failed to extract points %r %r', geom, dict(geom))
-            buffer.append((geom, rec))
-        except:
-            print('Failed to add row %r' % sr)
-            continue
-    print('Parsed shapefile, first few entries: %r' % buffer[:3])
-    return field_names, buffer
+
+    layer = ParsedLayer(layername, parsed_variant(False))
+    out = ParsedLayerWriter(layer.path, parsed_variant(convert, tolerance))
+    coverage = None
+    if tolerance:
+        geoms = layer.geometries(0, len(layer))
+        if len(geoms) and numpy.isin(shapely.get_type_id(geoms), (shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON)).all():
+            # Polygon layers are simplified as a whole coverage, so that neighbouring polygons keep their shared edges
+            # (simplifying each polygon by itself opens gaps and overlaps between them)
+            coverage = shapely.coverage_simplify(geoms, tolerance)
+    for start in range(0, len(layer), PARSE_CHUNK_SIZE):
+        stop = min(start + PARSE_CHUNK_SIZE, len(layer))
+        if coverage is not None:
+            geoms = coverage[start:stop]
+        else:
+            geoms = layer.geometries(start, stop)
+            if tolerance:
+                geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+        if convert:
+            geoms = shapely.transform(geoms, lambda coords: numpy.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+        if tolerance:
+            # Snapped to the precision grid, rather than rounded, so that thin rings stay valid
+            geoms = shapely.set_precision(geoms, 10 ** -COORDINATE_PRECISION[convert])
+        out.append(geoms)
+    out.close()
+    layer.close()
+
+
+def open_parsed_layer(layername, convert, tolerance=None):
+    # Opens a variant of the parsed layer - the variants are all prepared by process_layer before their writers start
+    variant = parsed_variant(convert, tolerance)
+    assert os.path.exists(os.path.join(parsed_path(layername), '%s.points.npy' % variant)), \
+        'Missing the %s variant of the parsed layer %s' % (variant, layername)
+    return ParsedLayer(layername, variant)
+
+
+def parse_shapefile(layername, convert, tolerance=None, geometry=True):
+    # Returns the field names and a generator of (geometry, record) pairs, read from the parsed layer.
+    # Without geometry, geometries are not decoded at all (the geometries returned are None) - the lat/lon fields
+    # are still filled in for points.
+    layer = open_parsed_layer(layername, convert, tolerance)
+    return layer.fields + ['lat', 'lon'], iter_parsed_layer(layer, layer.fields, geometry)
+
+
+def iter_parsed_layer(layer, fields, geometry):
+    import numpy
+    from shapely.geometry import mapping
+
+    for start in range(0, len(layer), PARSE_CHUNK_SIZE):
+        stop = min(start + PARSE_CHUNK_SIZE, len(layer))
+        records = layer.records(range(start, stop), fields)
+        geoms = layer.geometries(start, stop) if geometry else None
+        points = layer.points[start:stop]
+        for i, rec in enumerate(records):
+            lon, lat = points[i]
+            if numpy.isnan(lon):
+                rec['lon'], rec['lat'] = None, None
+            else:
+                rec['lon'], rec['lat'] = float(lon), float(lat)
+            yield (mapping(geoms[i]) if geoms is not None else None), rec
+    layer.close()
+
+
+def write_validation_report(layername, layer, issues):
+    # A single line summary, plus a CSV listing the rejected and repaired rows of the layer
+    import csv
+
+    rejected = sum(1 for issue in issues if issue[1] == 'REJECTED')
+    summary = 'VALIDATED %s: %d rows, %d repaired, %d rejected' % (layername, len(layer), len(issues) - rejected, rejected)
+    key_field = layer.fields[0] if layer.fields else None
+    rows = [
+        dict(
+            row=i,
+            # Only the key of the problematic rows is read
+            key=layer.records([i], [key_field])[0].get(key_field) if key_field else None,
+            action=action,
+            reason=reason,
+        )
+        for i, action, reason in sorted(issues)
+    ]
+    report_filename = '%s.validation.csv' % layername
+    with open(report_filename, 'w') as report:
+        w = csv.DictWriter(report, ['row', 'key', 'action', 'reason'])
+        w.writeheader()
+        w.writerows(rows)
+    print('%s (see %s)' % (summary, report_filename))
    
 
 def convert_to_csv(layername, out_filename, convert):
     import csv
 
-    fieldnames, buffer = parse_shapefile(layername, convert)
+    # Only the coordinates of points are needed
+    fieldnames, buffer = parse_shapefile(layername, convert, geometry=False)
 
     with open(out_filename, 'w') as csvfile:
         w = csv.DictWriter(csvfile, fieldnames)
@@ -63,27 +384,44 @@ def convert_to_csv(layername, out_filename, convert):
     return out_filename
 
 
-def convert_to_kml(layername, out_filename, convert):
+def convert_to_kml(layername, out_filename, convert, tolerance=None, description_fields=None):
     from fastkml import KML, Document, Placemark
     from fastkml.config import KMLNS as NS
 
-    fieldnames, buffer = parse_shapefile(layername, convert)
-
+    layer = open_parsed_layer(layername, convert, tolerance)
+    # The name field is the layer's first field (if it has any)
+    name_field = layer.fields[0] if layer.fields else None
+    if description_fields:
+        unknown_fields = [f for f in description_fields if f not in layer.fields]
+        if unknown_fields:
+            print('UNKNOWN KML DESCRIPTION FIELDS in %s: %s' % (layername, ', '.join(unknown_fields)))
+            description_fields = [f for f in description_fields if f not in unknown_fields]
+    if description_fields:
+        # Only the name field and the description fields are decoded
+        fields = [name_field] + [f for f in description_fields if f != name_field] if name_field else description_fields
+        fieldnames = description_fields
+    else:
+        fields = layer.fields
+        fieldnames = fields + ['lat', 'lon']
+    buffer = iter_parsed_layer(layer, fields, True)
 
     with open(out_filename, 'w') as kmlfile:
         kml = KML()
         doc = Document(ns=NS, name=layername)
         kml.append(doc)
 
+        bad_geometries = 0
         for geom, rec in buffer:
             description = ''.join('{}: {}<br/>'.format(f, rec.get(f, '')) for f in fieldnames)
             try:
-                pm = Placemark(name=str(rec[fieldnames[0]]),
+                pm = Placemark(name=str(rec[name_field]) if name_field else '',
                                description=description)
                 pm.geometry = geom
                 doc.append(pm)
             except:
-                print('BAD GEOMETRY for KML %r' % geom)
+                bad_geometries += 1
+        if bad_geometries:
+            print('BAD GEOMETRY for KML in %d placemarks' % bad_geometries)
         try:
             kmlfile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
             kmlfile.write(kml.to_string(prettyprint=True))
@@ -104,11 +442,23 @@ def get_geo_obj(layername, convert):
         )
 
 
-def convert_to_geojson(layername, out_filename, convert):
+def convert_to_geojson(layername, out_filename, convert, tolerance=None):
     import json
 
+    if tolerance:
+        # Simplified variants are meant to be small, so skip the indentation as well
+        dump_kwargs = dict(separators=(',', ':'))
+    else:
+        dump_kwargs = dict(indent=2)
+    _, buffer = parse_shapefile(layername, convert, tolerance)
+    # Features are written one by one, without holding the whole collection in memory
     with open(out_filename, 'w') as geojson:
-        json.dump(get_geo_obj(layername, convert), geojson, indent=2)
+        geojson.write('{"type": "FeatureCollection", "features": [\n')
+        for i, (geom, p) in enumerate(buffer):
+            if i > 0:
+                geojson.write(',\n')
+            json.dump(dict(type='Feature', geometry=geom, properties=p), geojson, **dump_kwargs)
+        geojson.write('\n]}\n')
     return out_filename
 
 
@@ -126,14 +476,254 @@ def convert_to_geoxml(layername, out_filename, convert):
     return out_filename
 
 
+def convert_to_mbtiles(layername, out_filename, min_zoom, max_zoom):
+    # Creates an MBTiles archive of Mapbox vector tiles from the WGS84 layer.
+    # Below max_zoom features are thinned out - lines and polygons are simplified to the tile's pixel size
+    # and limited to one per pixel when smaller than a pixel, points are limited to one per few pixels.
+    # Only the features' geometries are held in memory. Each tile's features are found with a spatial index and clipped
+    # together, their properties are read from the parsed layer, and the tiles are written to the archive as they are
+    # encoded.
+    import gzip
+    import json
+    import sqlite3
+    import numpy
+    import shapely
+    import mapbox_vector_tile
+    from pyproj import Transformer
+
+    EXTENT = 20037508.342789244
+    TILE_PIXELS = 256
+    POINT_SPACING = 4
+    FIELD_TYPES = {'C': 'String', 'N': 'Number', 'F': 'Number', 'L': 'Boolean'}
+
+    layer = open_parsed_layer(layername, True)
+    transformer = Transformer.from_crs('EPSG:4326', 'EPSG:3857', always_xy=True)
+    chunks = []
+    bounds = []
+    for start in range(0, len(layer), PARSE_CHUNK_SIZE):
+        geoms = layer.geometries(start, min(start + PARSE_CHUNK_SIZE, len(layer)))
+        bounds.append(shapely.total_bounds(geoms))
+        chunks.append(shapely.transform(geoms, lambda coords: numpy.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))))
+    geoms = numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=object)
+    # Indexes of the features in the parsed layer, for reading their properties
+    indexes = numpy.flatnonzero(~shapely.is_empty(geoms))
+    geoms = geoms[indexes]
+    if not len(geoms):
+        print('NO FEATURES for vector tiles in %s' % layername)
+        layer.close()
+        return None
+    bounds = numpy.array(bounds)
+    bounds = [numpy.nanmin(bounds[:, 0]), numpy.nanmin(bounds[:, 1]), numpy.nanmax(bounds[:, 2]), numpy.nanmax(bounds[:, 3])]
+    is_point = numpy.isin(shapely.get_type_id(geoms), (shapely.GeometryType.POINT, shapely.GeometryType.MULTIPOINT))
+
+    if os.path.exists(out_filename):
+        os.unlink(out_filename)
+    db = sqlite3.connect(out_filename)
+    db.execute('CREATE TABLE metadata (name text, value text)')
+    db.execute('CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+    db.execute('CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row)')
+
+    for zoom in range(min_zoom, max_zoom + 1):
+        tile_count = 2 ** zoom
+        tile_size = 2 * EXTENT / tile_count
+        pixel = tile_size / TILE_PIXELS
+        # Clip with a small buffer so that lines and polygon edges don't show at tile boundaries
+        buffer = tile_size / 64
+
+        zoom_geoms, zoom_indexes = geoms, indexes
+        if zoom < max_zoom:
+            feature_bounds = shapely.bounds(geoms)
+            large = (feature_bounds[:, 2] - feature_bounds[:, 0] >= pixel) | (feature_bounds[:, 3] - feature_bounds[:, 1] >= pixel)
+            small = numpy.flatnonzero(~is_point & ~large)
+            points = numpy.flatnonzero(is_point)
+            # One point per few pixels and one line or polygon per pixel is kept where they are smaller than that
+            point_cells = numpy.floor(shapely.get_coordinates(shapely.centroid(geoms[points])) / (pixel * POINT_SPACING))
+            small_cells = numpy.floor(shapely.get_coordinates(shapely.centroid(geoms[small])) / pixel)
+            _, first_point = numpy.unique(point_cells, axis=0, return_index=True)
+            _, first_small = numpy.unique(small_cells, axis=0, return_index=True)
+            keep = numpy.sort(numpy.concatenate([points[first_point], small[first_small], numpy.flatnonzero(~is_point & large)]))
+            zoom_geoms, zoom_indexes = geoms[keep], indexes[keep]
+            simplify = ~is_point[keep]
+            zoom_geoms[simplify] = shapely.simplify(zoom_geoms[simplify], pixel, preserve_topology=True)
+
+        # The tiles covered by the features' bounding boxes
+        feature_bounds = shapely.bounds(zoom_geoms)
+        ranges = numpy.column_stack([
+            numpy.clip((feature_bounds[:, 0] + EXTENT) // tile_size, 0, tile_count - 1),
+            numpy.clip((feature_bounds[:, 2] + EXTENT) // tile_size, 0, tile_count - 1),
+            numpy.clip((EXTENT - feature_bounds[:, 3]) // tile_size, 0, tile_count - 1),
+            numpy.clip((EXTENT - feature_bounds[:, 1]) // tile_size, 0, tile_count - 1),
+        ]).astype(numpy.int64)
+        tiles = set()
+        for min_col, max_col, min_row, max_row in numpy.unique(ranges, axis=0):
+            for col in range(min_col, max_col + 1):
+                tiles.update((col, row) for row in range(min_row, max_row + 1))
+
+        tree = shapely.STRtree(zoom_geoms)
+        created = 0
+        for col, row in sorted(tiles):
+            tile_bounds = (
+                col * tile_size - EXTENT, EXTENT - (row + 1) * tile_size,
+                (col + 1) * tile_size - EXTENT, EXTENT - row * tile_size,
+            )
+            clip_bounds = (tile_bounds[0] - buffer, tile_bounds[1] - buffer, tile_bounds[2] + buffer, tile_bounds[3] + buffer)
+            candidates = numpy.sort(tree.query(shapely.box(*clip_bounds)))
+            clipped = shapely.clip_by_rect(zoom_geoms[candidates], *clip_bounds)
+            not_empty = ~shapely.is_empty(clipped)
+            if not not_empty.any():
+                continue
+            records = layer.records(zoom_indexes[candidates[not_empty]])
+            encoded = [
+                dict(geometry=geom, properties=dict((k, v) for k, v in rec.items() if v is not None))
+                for geom, rec in zip(clipped[not_empty], records)
+            ]
+            data = mapbox_vector_tile.encode(
+                [dict(name=layername, features=encoded)],
+                default_options=dict(quantize_bounds=tile_bounds, extents=4096)
+            )
+            # MBTiles uses TMS row numbering
+            db.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)',
+                       (zoom, col, tile_count - 1 - row, sqlite3.Binary(gzip.compress(data))))
+            created += 1
+        db.commit()
+        print('CREATED %d TILES for zoom %d' % (created, zoom))
+
+    center_zoom = (min_zoom + max_zoom) // 2
+    metadata = dict(
+        name=layername,
+        format='pbf',
+        minzoom=str(min_zoom),
+        maxzoom=str(max_zoom),
+        bounds=','.join(str(x) for x in bounds),
+        center='%s,%s,%s' % ((bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, center_zoom),
+        json=json.dumps(dict(vector_layers=[dict(
+            id=layername,
+            fields=dict((f, FIELD_TYPES.get(layer.field_types[f], 'String')) for f in layer.fields),
+            minzoom=min_zoom,
+            maxzoom=max_zoom,
+        )])),
+    )
+    db.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+    db.commit()
+    db.close()
+    layer.close()
+
+    return out_filename
+
+
+def convert_to_pmtiles(layername, out_filename, min_zoom, max_zoom):
+    # PMTiles is a single file archive which map clients can read directly from the blobstore using range requests
+    import json
+    import sqlite3
+    from pmtiles.convert import mbtiles_to_header_json
+    from pmtiles.tile import zxy_to_tileid
+    from pmtiles.writer import write
+
+    mbtiles_filename = convert_to_mbtiles(layername, os.path.splitext(out_filename)[0] + '.mbtiles', min_zoom, max_zoom)
+    if mbtiles_filename is None:
+        return None
+    try:
+        db = sqlite3.connect(mbtiles_filename)
+        metadata = dict(db.execute('SELECT name, value FROM metadata'))
+        # MBTiles keeps vector_layers in a json string, PMTiles clients expect it as a top-level metadata key
+        metadata['vector_layers'] = json.loads(metadata.pop('json'))['vector_layers']
+        header, metadata = mbtiles_to_header_json(metadata)
+        # PMTiles tiles are written in tile id order, MBTiles uses TMS row numbering
+        tiles = sorted(
+            (zxy_to_tileid(zoom, col, (1 << zoom) - 1 - row), zoom, col, row)
+            for zoom, col, row in db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles')
+        )
+        with write(out_filename) as writer:
+            for tileid, zoom, col, row in tiles:
+                data, = db.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                   (zoom, col, row)).fetchone()
+                writer.write_tile(tileid, data)
+            writer.finalize(header, metadata)
+        db.close()
+    finally:
+        # Only the PMTiles archive is uploaded
+        os.unlink(mbtiles_filename)
+    return out_filename
+
+
+def precompress(filename):
+    # Returns a list of (filename, content encoding) of the compressed variants
+    import gzip
+    import shutil
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    variants = []
+    with open(filename, 'rb') as src, open(filename + '.gz', 'wb') as dst:
+        with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=9, mtime=0) as gz:
+            shutil.copyfileobj(src, gz)
+    variants.append((filename + '.gz', 'gzip'))
+    if brotli is not None:
+        with open(filename, 'rb') as src, open(filename + '.br', 'wb') as dst:
+            compressor = brotli.Compressor(quality=11)
+            for chunk in iter(lambda: src.read(1024*1024), b''):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+        variants.append((filename + '.br', 'br'))
+    return variants
+
+
+def upload_precompressed(container_client, filename, variants):
+    # Each variant is stored as <filename>.gz / <filename>.br, with the original content type and a matching encoding.
+    # Returns the URLs of the variants, by content encoding
+    import mimetypes
+    from azure.storage.blob import ContentSettings
+
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    urls = dict()
+    for variant, encoding in variants:
+        with open(variant, 'rb') as data:
+            blob_client = container_client.upload_blob(variant, data, overwrite=True,
+                                                       content_settings=ContentSettings(content_type=content_type, content_encoding=encoding))
+        urls[encoding] = blob_client.url
+        print('UPLOADED PRECOMPRESSED: %s' % variant)
+    return urls
+
+
+SHAPEFILE_FORMATS = ['shp', 'dbf', 'shx', 'prj', 'shp.xml']
+EXPORT_ARCHIVE = 'export.zip'
+# The configurations of the batch's layers, uploaded next to the remote script - a whole batch is too long to pass on
+# the command line (cmd.exe is limited to 8191 characters)
+LAYERS_FILE = 'layers.json'
+# Names of the layers which failed to export, packed in the export archive
+FAILED_LAYERS = 'failed.json'
+
+
+def layer_configs():
+    # A single layer is configured directly by env vars.
+    # In batch mode, BATCH_LAYERS holds a JSON list of objects - each one has the same keys as the
+    # env vars (LAYER_NAME, SDE_PATH, DATASET_NAME, ...) and overrides them for a single layer.
+    import json
+
+    batch = os.environ.get('BATCH_LAYERS')
+    if not batch:
+        return [dict(os.environ)]
+    configs = []
+    for overrides in json.loads(batch):
+        config = dict(os.environ)
+        config.update(overrides)
+        configs.append(config)
+    # Layers are exported under their own name, so the same layer can't appear twice in a batch
+    layer_names = [config['LAYER_NAME'] for config in configs]
+    duplicates = sorted(set(x for x in layer_names if layer_names.count(x) > 1))
+    assert not duplicates, 'Duplicate LAYER_NAME in BATCH_LAYERS: %s' % ', '.join(duplicates)
+    return configs
+
+
 def main():
     import fabric
-    import requests
     import zipfile
     import codecs
-    import datetime
-    import os
-    from lxml import etree
+    import json
+    import shutil
+    import traceback
 
     HOST = os.environ['SSH_HOST']
     USER = os.environ['SSH_USER']
@@ -141,50 +731,87 @@ def main():
     REMOTE_PYTHON = os.environ['REMOTE_PYTHON'] # e.g. 'c:\\python27\\ArcGISx6410.9\\python.exe'
     OUTPUT_LOCATION = os.environ['OUTPUT_LOCATION'] # e.g. '//gis-server/e$/directory'
 
-    LAYER_NAME = os.environ['LAYER_NAME']
-    DATASET_NAME = os.environ['DATASET_NAME']
-    PREFIX = os.environ.get('RESOURCE_NAME_PREFIX')
+    configs = layer_configs()
 
     def prepare_arg(x):
         return codecs.encode(x.encode('utf8'), 'hex').decode('ascii')
 
+    layers = [
+        dict(
+            sde=config['SDE_PATH'],
+            layer=config['LAYER_NAME'],
+            delete_fields=config.get('DELETE_FIELDS', ''),
+            rename_fields=config.get('RENAME_FIELDS', ''),
+            select_expression=config.get('SELECT_EXPRESSION', ''),
+        )
+        for config in configs
+    ]
+    with open(LAYERS_FILE, 'w') as f:
+        json.dump(layers, f)
     args = [
-        os.environ['SDE_PATH'],
-        LAYER_NAME,
-        prepare_arg(os.environ.get('DELETE_FIELDS', '')),
-        prepare_arg(os.environ.get('RENAME_FIELDS', '')),
-        prepare_arg(os.environ.get('SELECT_EXPRESSION', '')),
+        prepare_arg('c:\\scripts\\' + LAYERS_FILE),
         prepare_arg(OUTPUT_LOCATION),
     ]
 
-    dataset_dict = {
-        'name': DATASET_NAME,
-        'title': os.environ['DATASET_TITLE'],
-        'notes': os.environ['DATASET_DESCRIPTION'],
-        'owner_org': os.environ['DATASET_ORG_ID'],
-        'category': os.environ['DATASET_CATEGORY'],
-        'update_period': os.environ['DATASET_UPDATE_PERIOD'],
-        'private': os.environ['DATASET_PRIVATE'] == 'true',
-    }
-
-    # Convert dataset
+    # Convert all layers in a single remote invocation
     c = fabric.Connection(HOST, user=USER, connect_kwargs=dict(password=PW))
     script_file = os.path.abspath(sys.argv[0])
     c.put(script_file, '/scripts/remote.py')
+    c.put(LAYERS_FILE, '/scripts/' + LAYERS_FILE)
     cmd = REMOTE_PYTHON + ' c:\\scripts\\remote.py {}'.format(' '.join('"%s"' % x for x in args))
     print('running\n%s' % cmd)
     c.run(cmd)
 
-    FORMATS = ['shp', 'dbf', 'shx', 'prj', 'shp.xml']
+    # Fetch result - all layers are packed into a single archive on the remote side
+    filename = OUTPUT_LOCATION + '/' + EXPORT_ARCHIVE
+    print('fetching %s' % filename)
+    c.get(filename, EXPORT_ARCHIVE)
+    c.close()
+    with zipfile.ZipFile(EXPORT_ARCHIVE) as archive:
+        archive.extractall()
+        failed = json.loads(archive.read(FAILED_LAYERS).decode('utf8'))
+    if failed:
+        print('FAILED TO EXPORT LAYERS: %s' % ', '.join(failed))
+
+    for config in configs:
+        if config['LAYER_NAME'] in failed:
+            continue
+        try:
+            process_layer(config)
+        except Exception:
+            print('FAILED TO PROCESS LAYER %s' % config['LAYER_NAME'])
+            traceback.print_exc()
+            failed.append(config['LAYER_NAME'])
+        finally:
+            # The parsed layer holds a full copy of the layer's geometries per variant
+            shutil.rmtree(parsed_path(config['LAYER_NAME']), ignore_errors=True)
+    if failed:
+        print('FAILED LAYERS: %s' % ', '.join(failed))
+        sys.exit(1)
+
+
+def process_layer(config):
+    import requests
+    import zipfile
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from lxml import etree
+
+    LAYER_NAME = config['LAYER_NAME']
+    DATASET_NAME = config['DATASET_NAME']
+    PREFIX = config.get('RESOURCE_NAME_PREFIX')
+
+    dataset_dict = {
+        'name': DATASET_NAME,
+        'title': config['DATASET_TITLE'],
+        'notes': config['DATASET_DESCRIPTION'],
+        'owner_org': config['DATASET_ORG_ID'],
+        'category': config['DATASET_CATEGORY'],
+        'update_period': config['DATASET_UPDATE_PERIOD'],
+        'private': config['DATASET_PRIVATE'] == 'true',
+    }
 
-    # Fetch result
-    for ext in FORMATS:
-        filename = OUTPUT_LOCATION + '/%s.%s' % (LAYER_NAME, ext)
-        print('fetching %s' % filename)
-        c.get(filename)
-    
     # remove shp.xml
-    FORMATS = FORMATS[:-1] 
+    FORMATS = SHAPEFILE_FORMATS[:-1]
 
     if PREFIX:
         FILENAME = '%s - %s' % (DATASET_NAME, PREFIX)
@@ -196,24 +823,44 @@ def main():
         for ext in FORMATS:
             final.write('%s.%s' % (LAYER_NAME, ext), arcname='%s.%s' % (FILENAME, ext))
 
-    to_upload = [
-        ('SHP', out_filename)
-    ]
+    # Fields shown in the KML placemarks' description (all fields by default)
+    KML_DESCRIPTION_FIELDS = [f.strip() for f in config.get('KML_DESCRIPTION_FIELDS', '').split(',') if f.strip()] or None
 
-    to_upload.append(('GeoJSON', convert_to_geojson(LAYER_NAME, '%s.%s' % (FILENAME, 'geojson'), True)))
-    to_upload.append(('CSV', convert_to_csv(LAYER_NAME, '%s.%s' % (FILENAME, 'csv'), True)))
-    to_upload.append(('GeoXML', convert_to_geoxml(LAYER_NAME, '%s.%s' % (FILENAME, 'xml'), True)))
-    to_upload.append(('KML', convert_to_kml(LAYER_NAME, '%s.%s' % (FILENAME, 'kml'), True)))
-    to_upload.append(('GeoJSON-ITM', convert_to_geojson(LAYER_NAME, '%s.itm.%s' % (FILENAME, 'geojson'), False)))
-    to_upload.append(('CSV-ITM', convert_to_csv(LAYER_NAME, '%s.itm.%s' % (FILENAME, 'csv'), False)))
-    to_upload.append(('GeoXML-ITM', convert_to_geoxml(LAYER_NAME, '%s.itm.%s' % (FILENAME, 'xml'), False)))
-    to_upload.append(('KML-ITM', convert_to_kml(LAYER_NAME, '%s.itm.%s' % (FILENAME, 'kml'), False)))
-
-    # Upload to CKAN
-    base_url = os.environ.get('CKAN_HOSTNAME')
+    to_upload = []
+
+    def add_writer(to_upload_format, converter, *args):
+        # The converters' arguments all start with the output filename, convert and (for some) tolerance,
+        # which select the variant of the parsed layer they read
+        to_upload.append((to_upload_format, parsed_variant(*args[1:3]), converter, args))
+
+    add_writer('GeoJSON', convert_to_geojson, '%s.%s' % (FILENAME, 'geojson'), True)
+    add_writer('CSV', convert_to_csv, '%s.%s' % (FILENAME, 'csv'), True)
+    add_writer('GeoXML', convert_to_geoxml, '%s.%s' % (FILENAME, 'xml'), True)
+    add_writer('KML', convert_to_kml, '%s.%s' % (FILENAME, 'kml'), True, None, KML_DESCRIPTION_FIELDS)
+    add_writer('GeoJSON-ITM', convert_to_geojson, '%s.itm.%s' % (FILENAME, 'geojson'), False)
+    add_writer('CSV-ITM', convert_to_csv, '%s.itm.%s' % (FILENAME, 'csv'), False)
+    add_writer('GeoXML-ITM', convert_to_geoxml, '%s.itm.%s' % (FILENAME, 'xml'), False)
+    add_writer('KML-ITM', convert_to_kml, '%s.itm.%s' % (FILENAME, 'kml'), False, None, KML_DESCRIPTION_FIELDS)
+
+    # Simplified variants, one set per tolerance (in meters)
+    tolerances = []
+    for tolerance in config.get('SIMPLIFY_TOLERANCES', '').split(','):
+        if not tolerance.strip():
+            continue
+        tolerance = float(tolerance)
+        assert 0 < tolerance < float('inf'), 'Bad tolerance in SIMPLIFY_TOLERANCES: %s' % tolerance
+        # e.g. '2' and '2.0' are the same variant
+        if tolerance not in tolerances:
+            tolerances.append(tolerance)
+    for tolerance in tolerances:
+        add_writer('GeoJSON-%gm' % tolerance, convert_to_geojson, '%s.%gm.%s' % (FILENAME, tolerance, 'geojson'), True, tolerance)
+        add_writer('KML-%gm' % tolerance, convert_to_kml, '%s.%gm.%s' % (FILENAME, tolerance, 'kml'), True, tolerance, KML_DESCRIPTION_FIELDS)
+
+    # Prepare CKAN dataset
+    base_url = config.get('CKAN_HOSTNAME')
     if base_url:
         headers = {
-            'Authorization': os.environ['CKAN_API_KEY']
+            'Authorization': config['CKAN_API_KEY']
         }
         print('Creating dataset...')
         dataset = requests.post('%s/api/action/package_create' % base_url, 
@@ -243,92 +890,219 @@ def main():
         else:
             last_modified = dataset['metadata_created']
         print('MODIFICATION DATES: %r -> %s' % (mod_dates, last_modified))
-            
-        for to_upload_format, to_upload_filename in to_upload:
-            updated = False
-            orig_to_upload_format = to_upload_format
-            to_upload_name = to_upload_format
-            if PREFIX is not None:
-                to_upload_name = PREFIX + ' - ' + to_upload_name
-            print('CONSIDERING UPLOAD: FMT %s, FN %s, NAME %s' % (to_upload_format, to_upload_filename, to_upload_name))
-            for resource in existing_resources:
-                existing_filename = resource['url'].split('/')[-1]
-                if existing_filename == to_upload_filename and resource.get('name') == to_upload_name:
-                    to_upload_format = to_upload_format.split('-')[0]
-                    resource_dict = {
-                        'package_id': dataset['id'],
-                        'name': to_upload_name,
-                        'format': to_upload_format,
-                        'created': resource['created'],
-                        'position': resource['position'],
-                        'last_modified': last_modified,
-                        'id': resource['id'],
-                    }
-                    ret = requests.post('%s/api/action/resource_update' % base_url,
-                                        data=resource_dict, headers=headers,
-                                        files=[('upload', open(to_upload_filename, 'rb'))]).json()
-                    print('RESOURCE UPDATED: %s' % ret)
-                    updated = True
-                    break
-            if not updated:
+
+    # Formats whose resources are created in this run
+    created = []
+
+    def upload_to_ckan(to_upload_format, to_upload_filename):
+        if not base_url:
+            return None
+        to_upload_name = to_upload_format
+        if PREFIX is not None:
+            to_upload_name = PREFIX + ' - ' + to_upload_name
+        print('CONSIDERING UPLOAD: FMT %s, FN %s, NAME %s' % (to_upload_format, to_upload_filename, to_upload_name))
+        for resource in existing_resources:
+            existing_filename = resource['url'].split('/')[-1]
+            if existing_filename == to_upload_filename and resource.get('name') == to_upload_name:
+                to_upload_format = to_upload_format.split('-')[0]
                 resource_dict = {
                     'package_id': dataset['id'],
                     'name': to_upload_name,
                     'format': to_upload_format,
+                    'created': resource['created'],
+                    'position': resource['position'],
+                    'last_modified': last_modified,
+                    'id': resource['id'],
                 }
-                ret = requests.post('%s/api/action/resource_create' % base_url,
+                ret = requests.post('%s/api/action/resource_update' % base_url,
                                     data=resource_dict, headers=headers,
                                     files=[('upload', open(to_upload_filename, 'rb'))]).json()
-                print('RESOURCE CREATED:%s' % ret)
+                print('RESOURCE UPDATED: %s' % ret)
+                return ret.get('result')
+        resource_dict = {
+            'package_id': dataset['id'],
+            'name': to_upload_name,
+            'format': to_upload_format,
+        }
+        ret = requests.post('%s/api/action/resource_create' % base_url,
+                            data=resource_dict, headers=headers,
+                            files=[('upload', open(to_upload_filename, 'rb'))]).json()
+        print('RESOURCE CREATED:%s' % ret)
+        created.append(to_upload_format)
+        return ret.get('result')
+
+    blobstore_connection_str = config.get('BLOBSTORE_CONNECTION_STRING')
+    vector_tiles = blobstore_connection_str and config.get('VECTOR_TILES') == 'true'
+
+    # Parse and validate the layer once - the writers all read the (memory mapped) parsed layer
+    build_parsed_layer(LAYER_NAME)
+
+    # Run the format writers in parallel, uploading each artifact to CKAN as soon as it's ready.
+    # The ITM writers start right away, the others as soon as the variant of the parsed layer they read is derived.
+    converted = dict()
+    resources = dict()
+    with ProcessPoolExecutor(max_workers=int(config.get('WRITER_PROCESSES', 0)) or None) as pool:
+        derivations = dict(
+            (pool.submit(derive_parsed_layer, LAYER_NAME, *variant), parsed_variant(*variant))
+            for variant in [(True, None)] + [(True, tolerance) for tolerance in tolerances]
+        )
+        writers = dict()
+        tiles_future = None
+
+        def start_writers(variant):
+            started = set()
+            for to_upload_format, writer_variant, converter, args in to_upload:
+                if writer_variant == variant:
+                    future = pool.submit(converter, LAYER_NAME, *args)
+                    writers[future] = to_upload_format
+                    started.add(future)
+            return started
+
+        pending = set(derivations) | start_writers(parsed_variant(False))
+        resources['SHP'] = upload_to_ckan('SHP', out_filename)
+        precompressed = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in derivations:
+                    future.result()
+                    pending |= start_writers(derivations[future])
+                    if vector_tiles and derivations[future] == parsed_variant(True):
+                        min_zoom = int(config.get('VECTOR_TILES_MIN_ZOOM', 8))
+                        max_zoom = int(config.get('VECTOR_TILES_MAX_ZOOM', 16))
+                        tiles_future = pool.submit(convert_to_pmtiles, LAYER_NAME, '%s.%s' % (FILENAME, 'pmtiles'), min_zoom, max_zoom)
+                    continue
+                to_upload_format = writers[future]
+                converted[to_upload_format] = future.result()
+                resources[to_upload_format] = upload_to_ckan(to_upload_format, converted[to_upload_format])
+                if to_upload_format == 'GeoJSON' and blobstore_connection_str:
+                    # Only the GeoJSON is uploaded to the BlobStore
+                    precompressed = pool.submit(precompress, converted[to_upload_format])
+        if precompressed is not None:
+            precompressed = precompressed.result()
+        if tiles_future is not None:
+            tiles_future.result()
+
+    if created:
+        # Resources are uploaded in the order their writers finish - so that new datasets get the same order of
+        # resources on every run, they are reordered
+        order = [resources[to_upload_format]['id'] for to_upload_format in ['SHP'] + [x[0] for x in to_upload]
+                 if resources.get(to_upload_format)]
+        ret = requests.post('%s/api/action/package_resource_reorder' % base_url,
+                            json=dict(id=dataset['id'], order=order), headers=headers).json()
+        print('RESOURCES REORDERED: %s' % ret.get('success'))
 
     # Upload to BlobStore
-    blobstore_connection_str = os.environ.get('BLOBSTORE_CONNECTION_STRING')
     if blobstore_connection_str:
         from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
-        filename = '%s.%s' % (FILENAME, 'geojson')
-        src_filename = convert_to_geojson(LAYER_NAME, filename, True)
+        to_blobstore = [
+            converted['GeoJSON']
+        ]
+        if tiles_future is not None and tiles_future.result():
+            to_blobstore.append(tiles_future.result())
         blob_service_client = BlobServiceClient.from_connection_string(blobstore_connection_str)
-        container = os.environ['BLOBSTORE_CONTAINER']
+        container = config['BLOBSTORE_CONTAINER']
         container_client = blob_service_client.get_container_client(container)
-        with open(src_filename, 'rb') as data:
-            container_client.upload_blob(filename, data, overwrite=True)
-            print('UPLOADED: %s to CONTAINER %s' % (filename, container))
+        for filename in to_blobstore:
+            with open(filename, 'rb') as data:
+                container_client.upload_blob(filename, data, overwrite=True)
+                print('UPLOADED: %s to CONTAINER %s' % (filename, container))
+        urls = upload_precompressed(container_client, converted['GeoJSON'], precompressed)
+        if resources.get('GeoJSON'):
+            resource_dict = dict(('url_%s' % encoding, url) for encoding, url in urls.items())
+            resource_dict['id'] = resources['GeoJSON']['id']
+            ret = requests.post('%s/api/action/resource_patch' % base_url,
+                                json=resource_dict, headers=headers).json()
+            print('RESOURCE PRECOMPRESSED URLS UPDATED: %s' % ret.get('success'))
 
 
 def main_remote():
     import arcpy
+    import json
     import shutil
     import time
+    import traceback
+    import zipfile
 
     def prepare_arg(x):
         return x.decode('hex').decode('utf8')    
 
-    sde, layer, fields2delete, rename, select_expression, output_base = sys.argv[1:]
-    fields2delete, rename, select_expression = prepare_arg(fields2delete), prepare_arg(rename), prepare_arg(select_expression)
+    layers_file, output_base = [prepare_arg(x) for x in sys.argv[1:]]
+    with open(layers_file) as f:
+        layers = json.load(f)
 
     output_base = output_base.replace('/', '\\')
     shutil.rmtree(output_base, ignore_errors=True)
     time.sleep(3)
     os.mkdir(output_base)
 
-    # Local variables:
-    source = sde
-
     # Set Geoprocessing environments
     arcpy.env.outputCoordinateSystem = ""
 
     # Process: Feature Class to Geodatabase (multiple)
+    # All the sources of the batch are copied together
     tempdb = output_base + 'convert.gdb'
     arcpy.CreateFileGDB_management(output_base, 'convert.gdb')
     time.sleep(3)
 
-    arcpy.FeatureClassToGeodatabase_conversion("'%s'" % source, tempdb)
+    sources = []
+    for layer in layers:
+        if layer['sde'] not in sources:
+            sources.append(layer['sde'])
+    failed_sources = []
+    try:
+        arcpy.FeatureClassToGeodatabase_conversion(';'.join("'%s'" % source for source in sources), tempdb)
+    except Exception:
+        # Copy the sources one by one, so that a bad source only fails its own layers.
+        # The batch may have failed after copying some of the sources, so start over with an empty geodatabase
+        traceback.print_exc()
+        arcpy.Delete_management(tempdb)
+        arcpy.CreateFileGDB_management(output_base, 'convert.gdb')
+        time.sleep(3)
+        for source in sources:
+            try:
+                arcpy.FeatureClassToGeodatabase_conversion("'%s'" % source, tempdb)
+            except Exception:
+                print('FAILED TO COPY SOURCE %s' % source)
+                traceback.print_exc()
+                failed_sources.append(source)
+
+    selectdb = None
+    if any(layer['select_expression'] for layer in layers):
+        selectdb = output_base + 'select.gdb'
+        arcpy.CreateFileGDB_management(output_base, 'select.gdb')
+
+    failed = []
+    for layer in layers:
+        if layer['sde'] in failed_sources:
+            failed.append(layer['layer'])
+            continue
+        try:
+            export_layer_remote(output_base, tempdb, selectdb, layer['layer'],
+                                layer['delete_fields'], layer['rename_fields'], layer['select_expression'])
+        except Exception:
+            print('FAILED TO EXPORT LAYER %s' % layer['layer'])
+            traceback.print_exc()
+            failed.append(layer['layer'])
+
+    # Pack all layers into a single archive, so they can be fetched in one go
+    with zipfile.ZipFile(os.path.join(output_base, EXPORT_ARCHIVE), 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for layer in layers:
+            if layer['layer'] in failed:
+                continue
+            for ext in SHAPEFILE_FORMATS:
+                filename = '%s.%s' % (layer['layer'], ext)
+                archive.write(os.path.join(output_base, filename), arcname=filename)
+        archive.writestr(FAILED_LAYERS, json.dumps(failed))
+
+
+def export_layer_remote(output_base, tempdb, selectdb, layer, fields2delete, rename, select_expression):
+    import arcpy
+
     templayer = tempdb + '\\' + layer
 
     if select_expression:
-        tempdb = output_base + 'select.gdb'
-        arcpy.CreateFileGDB_management(output_base, 'select.gdb')
-        templayer2 = tempdb + '\\' + layer
+        templayer2 = selectdb + '\\' + layer
         arcpy.Select_analysis(templayer, templayer2, select_expression)
         templayer = templayer2
 
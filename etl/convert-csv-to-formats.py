@@ -1,4 +1,6 @@
 import os
+import re
+import math
 import json
 from pathlib import PurePath
 import requests
@@ -7,12 +9,27 @@ import datetime
 import tabulator
 import dateutil.parser
 from json2xml import json2xml
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # This script runs over all datasets in the source CKAN instance,
 # locates all resources of CSV format and creates identical resources in the same dataset with different formats:
 # - XLSX
 # - JSON
+# - NDJSON (one JSON object per line)
 # - XML
+#
+# When run by etl-runner.py, the datasets are read from the catalog snapshot in CATALOG_SNAPSHOT.
+
+# Column types for the JSON outputs are inferred from the stream's sample.
+# Integers are limited to 15 digits (so they stay exact in JS), and values with leading zeros (ids, phone numbers) stay strings.
+INTEGER = re.compile(r'^-?(0|[1-9][0-9]{0,14})$')
+NUMBER = re.compile(r'^-?(0|[1-9][0-9]*)(\.[0-9]+)?$')
+BOOLEANS = {'true': True, 'false': False}
+JSON_BATCH_SIZE = 1000
+JSON_WRITE_BUFFER = 1024*1024
 
 now = datetime.datetime.now().isoformat()
 session = requests.Session()
@@ -34,6 +51,12 @@ def lm(resource, next=False, iso=True):
     
 
 def all_datasets(base_url):
+    if os.environ.get('CATALOG_SNAPSHOT'):
+        # Provided by etl-runner.py
+        print('USING CATALOG SNAPSHOT {}'.format(os.environ['CATALOG_SNAPSHOT']))
+        with open(os.environ['CATALOG_SNAPSHOT']) as f:
+            yield from json.load(f)
+        return
     print(f'GETTING ALL IDS from {base_url}')
     datasets = session.get(f'{base_url}/api/3/action/current_package_list_with_resources?limit=1000').json()['result']
     for d in datasets:
@@ -45,17 +68,77 @@ def convert_to_XLSX(csv_url, filename):
     with tabulator.Stream(csv_url, headers=1, http_session=session) as s:
         s.save(filename, sheet=dataset['name'])
 
-def convert_to_JSON(csv_url, filename):
+def cast_integer(value):
+    return int(value) if INTEGER.fullmatch(value) else value
+
+def cast_number(value):
+    if not NUMBER.fullmatch(value):
+        return value
+    number = float(value)
+    # Too many digits for a float
+    return number if math.isfinite(number) else value
+
+def cast_boolean(value):
+    return BOOLEANS.get(value.lower(), value)
+
+def infer_caster(values):
+    values = [v for v in values if v not in ('', None)]
+    if not values or not all(isinstance(v, str) for v in values):
+        return None
+    if all(INTEGER.fullmatch(v) for v in values):
+        return cast_integer
+    if all(NUMBER.fullmatch(v) for v in values):
+        return cast_number
+    if all(v.lower() in BOOLEANS for v in values):
+        return cast_boolean
+    return None
+
+def cast(caster, value):
+    # Values which don't match the column's type (the sample wasn't representative) stay strings
+    if caster is None or not isinstance(value, str):
+        return value
+    if value == '':
+        return None
+    return caster(value)
+
+def encode_json(row):
+    if orjson is not None:
+        return orjson.dumps(row)
+    return json.dumps(row, ensure_ascii=False).encode('utf8')
+
+def json_batches(csv_url):
+    # Yields lists of encoded rows, JSON_BATCH_SIZE at a time
     with tabulator.Stream(csv_url, headers=1, http_session=session) as s:
-        with open(filename, 'w', encoding='utf8') as o:
-            o.write('[\n')
-            first = True
-            for row in s.iter(keyed=True):
-                if not first:
-                    o.write(',\n')
-                first = False
-                o.write(json.dumps(row, ensure_ascii=False))
-            o.write('\n]\n')
+        headers = s.headers
+        casters = [infer_caster(column) for column in zip(*s.sample)] if s.sample else []
+        casters += [None] * (len(headers) - len(casters))
+        batch = []
+        for row in s.iter():
+            batch.append(encode_json(dict(
+                (header, cast(caster, value)) for header, caster, value in zip(headers, casters, row)
+            )))
+            if len(batch) == JSON_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def convert_to_JSON(csv_url, filename):
+    with open(filename, 'wb', buffering=JSON_WRITE_BUFFER) as o:
+        o.write(b'[\n')
+        first = True
+        for batch in json_batches(csv_url):
+            if not first:
+                o.write(b',\n')
+            first = False
+            o.write(b',\n'.join(batch))
+        o.write(b'\n]\n')
+
+def convert_to_NDJSON(csv_url, filename):
+    with open(filename, 'wb', buffering=JSON_WRITE_BUFFER) as o:
+        for batch in json_batches(csv_url):
+            o.write(b'\n'.join(batch))
+            o.write(b'\n')
 
 def convert_to_XML(csv_url, filename):
     with tabulator.Stream(csv_url, headers=1, http_session=session) as s:
@@ -71,6 +154,8 @@ def convert_to_XML(csv_url, filename):
 
 if __name__=='__main__':
     base_url = os.environ['CKAN_HOSTNAME']
+    # Resources deleted below, which a catalog snapshot still lists
+    deleted = set()
 
     for dataset in all_datasets(base_url):
         resources = dataset['resources']
@@ -86,9 +171,10 @@ if __name__=='__main__':
                     id = res['id']
                     resp = session.post('%s/api/action/resource_delete' % base_url, data=dict(id=id))
                     print(resp)
+                    deleted.add(id)
 
     for dataset in all_datasets(base_url):
-        resources = dataset['resources']
+        resources = [resource for resource in dataset['resources'] if resource['id'] not in deleted]
 
         CSVs=[]
         for resource in resources:
@@ -97,7 +183,7 @@ if __name__=='__main__':
         print('FOUND {} CSV RESOURCES'.format(len(CSVs)))
         while len(CSVs) > 0:
             csv_resource = CSVs.pop(0)
-            for new_format, new_suffix in (('XLSX', '.xlsx'), ('JSON', '.json'), ('XML', '.xml')):
+            for new_format, new_suffix in (('XLSX', '.xlsx'), ('JSON', '.json'), ('NDJSON', '.ndjson'), ('XML', '.xml')):
                 new_name = csv_resource['name'].upper()
                 if 'CSV' in new_name:
                     new_name = new_name.replace('CSV', new_format)
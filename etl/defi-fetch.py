@@ -1,22 +1,46 @@
 import os
+import sys
+import json
 import shutil
 import dataflows as DF
 from dataflows_ckan import dump_to_ckan
 import datetime
 
 # This script is used to fetch data from the Defi app and create a CKAN dataset with it.
+#
+# The previous fetch is kept in a checkpoint. The new response is compared to it by record id and 'updatedAt',
+# and when no record was added, updated or deleted the dataset is not dumped to CKAN at all.
+# Set FULL_REFRESH=true to dump the dataset regardless.
 
 URL = 'https://us-central1-eifo-defi.cloudfunctions.net/api/defis?key=apikey'
+FULL_REFRESH = os.environ.get('FULL_REFRESH') == 'true'
+
+def record_versions(rows):
+    return dict(
+        (row['id'], json.dumps(row.get('updatedAt') or row, sort_keys=True, default=str))
+        for row in rows
+    )
 
 if __name__ == '__main__':
-    shutil.rmtree('.checkpoints/defi', ignore_errors=True)
-    DF.Flow(
+    shutil.rmtree('.checkpoints/defi-new', ignore_errors=True)
+    current = DF.Flow(
         DF.load(URL, name='defi', format='json'),
-        DF.checkpoint('defi'),
-    ).process()
+        DF.checkpoint('defi-new'),
+    ).results()[0][0]
+
+    if os.path.exists('.checkpoints/defi') and not FULL_REFRESH:
+        previous = record_versions(DF.Flow(DF.checkpoint('defi')).results()[0][0])
+        current = record_versions(current)
+        changed = [id for id, version in current.items() if previous.get(id) != version]
+        deleted = [id for id in previous if id not in current]
+        print('CHANGED: {} records, DELETED: {} records'.format(len(changed), len(deleted)))
+        if not changed and not deleted:
+            print('No changes since last run, skipping')
+            shutil.rmtree('.checkpoints/defi-new')
+            sys.exit(0)
 
     DF.Flow(
-        DF.checkpoint('defi'),
+        DF.checkpoint('defi-new'),
         DF.filter_rows(lambda row: row['id'] != 'copyrights-1'),
         DF.set_type('contactName', type='string', transform=str),
         DF.add_field('lat', 'number', lambda row: row['coordinates']['geopoint']['latitude']),
@@ -39,4 +63,8 @@ if __name__ == '__main__':
             os.environ['DATASET_ORG_ID'],
             force_format=False,
         )
-    ).process()
\ No newline at end of file
+    ).process()
+
+    # Only keep the new checkpoint once it was successfully dumped, so that a failed run is retried next time
+    shutil.rmtree('.checkpoints/defi', ignore_errors=True)
+    os.rename('.checkpoints/defi-new', '.checkpoints/defi')
@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import runpy
+import datetime
+import tempfile
+import importlib
+import multiprocessing
+from multiprocessing.connection import wait
+import requests
+
+# This script runs the ETL scripts in this directory as a DAG of jobs, in a single warm process,
+# instead of starting a cold Jenkins job per script.
+#
+# Jobs are defined in a JSON file (path in JOBS_FILE), which holds a list of objects with:
+# - name: a unique job name
+# - script: the script to run, e.g. 'arcgis-fetch-convert.py'
+# - env: the env vars the script is configured with (the same ones its Jenkins job sets)
+# - after: (optional) names of jobs which must succeed before this job runs
+# - catalog: (optional) true if the job can use a shared snapshot of the CKAN catalog
+#
+# Heavy modules are imported once by the runner, and each job runs in a process forked from it - so jobs start warm,
+# but still can't clash over env vars (which the scripts read at import time).
+# Independent jobs run in parallel, up to RUNNER_PROCESSES at a time (defaults to the number of CPUs).
+# Each job runs in its own directory under RUNNER_WORKDIR (default '.runner'), which also holds its output.log.
+# The CKAN catalog (including private datasets) is fetched at most once (per CKAN_HOSTNAME) between jobs which may
+# modify it, with the job's own CKAN_HOSTNAME/CKAN_API_KEY, and handed to jobs in the file pointed to by the
+# CATALOG_SNAPSHOT env var.
+# resource-toucher.py and convert-csv-to-formats.py read the snapshot instead of fetching the catalog themselves.
+# A summary of the jobs' results is written to RESULTS_FILE (default 'results.json').
+# When RUNNER_INTERVAL is set, the whole DAG runs again every RUNNER_INTERVAL seconds.
+
+PRELOAD = [
+    'requests', 'dateutil.parser', 'dataflows', 'dataflows_ckan', 'tabulator', 'json2xml.json2xml',
+    'pyproj', 'shapely', 'shapefile', 'fastkml', 'lxml.etree', 'fabric', 'azure.storage.blob',
+]
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+JOBS_FILE = os.environ['JOBS_FILE']
+RUNNER_PROCESSES = int(os.environ.get('RUNNER_PROCESSES', 0)) or os.cpu_count()
+RUNNER_WORKDIR = os.path.abspath(os.environ.get('RUNNER_WORKDIR', '.runner'))
+RESULTS_FILE = os.path.abspath(os.environ.get('RESULTS_FILE', 'results.json'))
+RUNNER_INTERVAL = int(os.environ.get('RUNNER_INTERVAL', 0))
+
+session = requests.Session()
+
+def preload():
+    for module in PRELOAD:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            print('PRELOAD: {} not available'.format(module))
+
+def load_jobs(filename):
+    with open(filename) as f:
+        jobs = json.load(f)
+    names = [job['name'] for job in jobs]
+    # Jobs are identified by their name, in the results and in their work directories
+    duplicates = sorted(set(x for x in names if names.count(x) > 1))
+    assert not duplicates, 'Duplicate job names: {}'.format(', '.join(duplicates))
+    names = set(names)
+    for job in jobs:
+        missing = set(job.get('after', [])) - names
+        assert not missing, 'Job {} depends on unknown jobs {}'.format(job['name'], missing)
+    return jobs
+
+def fetch_catalog(env):
+    # Fetched with the CKAN instance and credentials of the job which asked for it.
+    # Each snapshot goes to a new file, as jobs which got an earlier snapshot may still be reading it.
+    base_url = env['CKAN_HOSTNAME']
+    headers = {
+        'Authorization': env['CKAN_API_KEY']
+    }
+    print(f'GETTING CATALOG SNAPSHOT from {base_url}')
+    datasets = []
+    while True:
+        result = session.get(f'{base_url}/api/3/action/package_search', headers=headers,
+                             params=dict(q='*:*', rows=1000, start=len(datasets), include_private=True)).json()['result']
+        datasets.extend(result['results'])
+        if not result['results'] or len(datasets) >= result['count']:
+            break
+    fd, filename = tempfile.mkstemp(prefix='catalog.', suffix='.json', dir=RUNNER_WORKDIR)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(datasets, f)
+    print('CATALOG SNAPSHOT: {} datasets in {}'.format(len(datasets), filename))
+    return filename
+
+def run_job(job, workdir, env):
+    # Runs in the forked process
+    log = open(os.path.join(workdir, 'output.log'), 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    os.environ.clear()
+    os.environ.update(env)
+    os.chdir(workdir)
+    script = os.path.join(SCRIPTS_DIR, job['script'])
+    sys.argv = [script]
+    runpy.run_path(script, run_name='__main__')
+
+def run_dag(jobs):
+    context = multiprocessing.get_context('fork')
+    results = dict()
+    running = dict()
+    # Catalog snapshots by CKAN instance, and all the snapshot files fetched in this run
+    catalogs = dict()
+    snapshots = []
+    pending = list(jobs)
+    while pending or running:
+        # Skip jobs whose dependencies failed
+        for job in list(pending):
+            if any(results.get(dep, {}).get('status') in ('failed', 'skipped') for dep in job.get('after', [])):
+                print('SKIPPING {}'.format(job['name']))
+                results[job['name']] = dict(name=job['name'], script=job['script'], status='skipped')
+                pending.remove(job)
+
+        # Start all ready jobs
+        failed_to_start = False
+        for job in list(pending):
+            if len(running) >= RUNNER_PROCESSES:
+                break
+            if not all(results.get(dep, {}).get('status') == 'success' for dep in job.get('after', [])):
+                continue
+            workdir = os.path.join(RUNNER_WORKDIR, job['name'])
+            os.makedirs(workdir, exist_ok=True)
+            env = dict(os.environ)
+            env.update(job.get('env', {}))
+            if job.get('catalog'):
+                host = env.get('CKAN_HOSTNAME')
+                try:
+                    if host not in catalogs:
+                        catalogs[host] = fetch_catalog(env)
+                        snapshots.append(catalogs[host])
+                except Exception as e:
+                    # Fails only this job (and the ones depending on it)
+                    print('FAILED TO GET CATALOG SNAPSHOT for {}: {!r}'.format(job['name'], e))
+                    results[job['name']] = dict(name=job['name'], script=job['script'], status='failed',
+                                                error='Failed to get catalog snapshot: {!r}'.format(e))
+                    pending.remove(job)
+                    failed_to_start = True
+                    continue
+                env['CATALOG_SNAPSHOT'] = catalogs[host]
+            print('STARTING {} ({})'.format(job['name'], job['script']))
+            process = context.Process(target=run_job, args=(job, workdir, env), name=job['name'])
+            process.start()
+            running[process.sentinel] = (job, process, time.time(), workdir)
+            pending.remove(job)
+
+        if not running:
+            if failed_to_start:
+                # Skip the jobs depending on it first
+                continue
+            assert not pending, 'Jobs can never run: {}'.format([job['name'] for job in pending])
+            break
+
+        # Wait for any job to finish
+        for sentinel in wait(list(running.keys())):
+            job, process, started, workdir = running.pop(sentinel)
+            process.join()
+            status = 'success' if process.exitcode == 0 else 'failed'
+            results[job['name']] = dict(
+                name=job['name'],
+                script=job['script'],
+                status=status,
+                exit_code=process.exitcode,
+                started=datetime.datetime.fromtimestamp(started).isoformat(),
+                duration=round(time.time() - started, 1),
+                log=os.path.join(workdir, 'output.log'),
+            )
+            print('FINISHED {}: {} in {}s'.format(job['name'], status.upper(), results[job['name']]['duration']))
+            # The job might have modified the catalog
+            catalogs = dict()
+
+    # No job is running anymore, so none of the snapshots is still being read
+    for filename in snapshots:
+        os.unlink(filename)
+    return [results[job['name']] for job in jobs]
+
+if __name__ == '__main__':
+    preload()
+    while True:
+        jobs = load_jobs(JOBS_FILE)
+        os.makedirs(RUNNER_WORKDIR, exist_ok=True)
+        results = run_dag(jobs)
+        with open(RESULTS_FILE, 'w') as f:
+            json.dump(results, f, indent=2)
+        for result in results:
+            print('{name}: {status}'.format(**result))
+        failed = [result['name'] for result in results if result['status'] != 'success']
+        if not RUNNER_INTERVAL:
+            sys.exit(1 if failed else 0)
+        time.sleep(RUNNER_INTERVAL)
@@ -1,36 +1,86 @@
 import os
+import json
 import requests
 import datetime
+import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor
 
 # This (quite specific) script ensures that the last modified dates of URL resources in datasets are more 'reasonable'.
 # The logic goes as follows:
 # For all datasets and all resources, when a resource's format is 'URL':
 # - When the dataset's update period is 'ONLINE', we set the date to be today
 # - When the dataset's update period is NOT 'ONLINE', we force the date to be the creation date of the dataset
+#
+# Target dates are computed from a single snapshot of the catalog, and only resources whose date actually changes
+# are patched (every update triggers a reindex of the dataset). Updates are sent CONCURRENCY at a time (default 4).
+# Set FORCE_UPDATE=true to patch all URL resources regardless.
+# When run by etl-runner.py, the catalog snapshot is read from the file in CATALOG_SNAPSHOT.
 
-now = datetime.datetime.now().isoformat()
+now = datetime.datetime.now()
+CONCURRENCY = int(os.environ.get('CONCURRENCY', 4))
+FORCE_UPDATE = os.environ.get('FORCE_UPDATE') == 'true'
+session = requests.Session()
 
-def all_datasets(base_url, headers):
-    print(f'GETTING ALL IDS from {base_url}')
-    dataset_ids = requests.get(f'{base_url}/api/3/action/package_list', headers=headers).json()['result']
-    for id in dataset_ids:
-        print('DATASET ID', id)
-        yield requests.get(f'{base_url}/api/3/action/package_show?id={id}&cachebusting={now}', headers=headers).json()['result']
+def all_datasets(base_url):
+    if os.environ.get('CATALOG_SNAPSHOT'):
+        # Provided by etl-runner.py
+        print('USING CATALOG SNAPSHOT {}'.format(os.environ['CATALOG_SNAPSHOT']))
+        with open(os.environ['CATALOG_SNAPSHOT']) as f:
+            yield from json.load(f)
+        return
+    print(f'GETTING ALL DATASETS from {base_url}')
+    start = 0
+    while True:
+        result = session.get(f'{base_url}/api/3/action/package_search',
+                             params=dict(q='*:*', rows=1000, start=start, cachebusting=now.isoformat())).json()['result']
+        for dataset in result['results']:
+            yield dataset
+        start += len(result['results'])
+        if not result['results'] or start >= result['count']:
+            break
+
+def same_time(a, b):
+    return bool(a) and bool(b) and dateutil.parser.isoparse(a) == dateutil.parser.isoparse(b)
+
+def target_last_modified(dataset, resource):
+    if dataset['update_period'].upper() == 'ONLINE':
+        # Already touched today
+        last_modified = resource.get('last_modified')
+        if last_modified and dateutil.parser.isoparse(last_modified).date() == now.date():
+            return last_modified
+        return now.isoformat()
+    else:
+        return resource['created']
+
+def patch_resource(base_url, resource, last_modified):
+    ret = session.post('%s/api/action/resource_patch' % base_url,
+                       json=dict(id=resource['id'], last_modified=last_modified)).json()
+    print('RESOURCE UPDATED: {}, {}, {}'.format(resource['name'], resource['url'], ret.get('success')))
+    return ret
 
 if __name__=='__main__':
     base_url = os.environ['CKAN_HOSTNAME']
-    headers = {
+    session.headers.update({
         'Authorization': os.environ['CKAN_API_KEY']
-    }
+    })
 
-    for dataset in all_datasets(base_url, headers):
+    to_patch = []
+    total = 0
+    for dataset in all_datasets(base_url):
+        if dataset.get('private'):
+            # Only public datasets are touched (the catalog snapshot includes private ones as well)
+            continue
         resources = dataset['resources']
         for resource in resources:
             if resource['format'].upper() == 'URL':
-                if dataset['update_period'].upper() == 'ONLINE':
-                    resource['last_modified'] = datetime.datetime.now().isoformat()
-                else:
-                    resource['last_modified'] = resource['created']
-                ret = requests.post('%s/api/action/resource_update' % base_url,
-                                    data=resource, headers=headers).json()
-                print('RESOURCE UPDATED: {}, {}, {}'.format(dataset, resource['name'], resource['url']))
+                total += 1
+                last_modified = target_last_modified(dataset, resource)
+                if FORCE_UPDATE or not same_time(last_modified, resource.get('last_modified')):
+                    to_patch.append((resource, last_modified))
+    print('FOUND {} URL RESOURCES, {} TO UPDATE'.format(total, len(to_patch)))
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        results = list(pool.map(lambda x: patch_resource(base_url, *x), to_patch))
+    failed = [ret for ret in results if not ret.get('success')]
+    if failed:
+        print('FAILED TO UPDATE {} RESOURCES: {}'.format(len(failed), failed))